@@ -28,11 +28,15 @@ SOIL_MOISTURE_MIN = 10
 SOIL_MOISTURE_MAX = 80
 
 # Language (ar = Arabic, en = English)
-DEFAULT_LANGUAGE = "en"
+DEFAULT_LANGUAGE = "ar"
 
 # Logging
 LOG_LEVEL = "INFO"
 LOG_FILE = "iq_farm.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024  # Rotate the log file after 5 MB
+LOG_BACKUP_COUNT = 3  # Number of rotated log files to keep
+LOG_QUEUE_SIZE = 10000  # Records beyond this are dropped instead of blocking
+LOG_SAMPLE_RATE = 0.1  # Fraction of requests whose timing spans are logged (0-1)
 
 # Visualization
 CHART_DPI = 100
@@ -1,6 +1,14 @@
 """IQ-FARM"""
 import os
 import json
+import time
+import queue
+import random
+import uuid
+import copy
+import logging
+import logging.handlers
+from contextlib import contextmanager
 import pandas as pd
 import numpy as np
 from datetime import datetime
@@ -26,6 +34,174 @@ TOKEN = config.BOT_TOKEN
 ADMIN_ID = config.ADMIN_USER_ID
 
 
+# ============================================================================
+# LOGGING
+# ============================================================================
+class JsonFormatter(logging.Formatter):
+    """تنسيق سجلات السجل كسطور JSON"""
+    FIELDS = ('request_id', 'user_id', 'callback', 'phase', 'duration_ms', 'ok', 'error')
+    
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """إرسال السجلات إلى الطابور دون حجب، وإسقاطها عند امتلائه"""
+    
+    def prepare(self, record):
+        # Keep exc_info so the traceback is formatted on the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+log_queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+logger = logging.getLogger('iq_farm')
+logger.setLevel(getattr(logging, str(config.LOG_LEVEL).upper(), logging.INFO))
+logger.addHandler(DroppingQueueHandler(log_queue))
+logger.propagate = False
+
+
+def start_log_listener():
+    """تشغيل خيط الكتابة في الخلفية مع تدوير الملف حسب الحجم"""
+    file_handler = logging.handlers.RotatingFileHandler(
+        config.LOG_FILE,
+        maxBytes=config.LOG_MAX_BYTES,
+        backupCount=config.LOG_BACKUP_COUNT,
+        encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def new_trace(user_id, callback):
+    """إنشاء سياق تتبع لطلب واحد مع قرار أخذ العينة"""
+    return {
+        'request_id': uuid.uuid4().hex[:12],
+        'user_id': user_id,
+        'callback': callback,
+        'sampled': random.random() < config.LOG_SAMPLE_RATE
+    }
+
+
+@contextmanager
+def log_span(trace, phase):
+    """قياس زمن مرحلة وتسجيله للطلبات المختارة، وتسجيل المراحل الفاشلة دائماً"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        logger.warning('span', extra={
+            'request_id': trace['request_id'],
+            'user_id': trace['user_id'],
+            'callback': trace['callback'],
+            'phase': phase,
+            'duration_ms': round((time.perf_counter() - start_time) * 1000, 2),
+            'ok': False,
+            'error': repr(e)
+        })
+        raise
+    if trace['sampled']:
+        logger.info('span', extra={
+            'request_id': trace['request_id'],
+            'user_id': trace['user_id'],
+            'callback': trace['callback'],
+            'phase': phase,
+            'duration_ms': round((time.perf_counter() - start_time) * 1000, 2),
+            'ok': True
+        })
+
+
+# ============================================================================
+# RECOMMENDATION RESULTS
+# ============================================================================
+# Bit flags for the soil checks a crop passed during scoring
+CHECK_PH = 1 << 0
+CHECK_NITROGEN = 1 << 1
+CHECK_RAINFALL = 1 << 2
+CHECK_MOISTURE = 1 << 3
+
+# User-facing recommendation text per language; 'reasons' holds
+# (flag, passed text, failed text) for each soil check
+TEXT_CATALOG = {
+    'ar': {
+        'reasons': [
+            (CHECK_PH, "✓ حموضة التربة مناسبة", "✗ حموضة التربة غير مثالية"),
+            (CHECK_NITROGEN, "✓ النيتروجين كافٍ", "⚠ النيتروجين منخفض"),
+            (CHECK_RAINFALL, "✓ الأمطار مناسبة", "⚠ الأمطار منخفضة"),
+            (CHECK_MOISTURE, "✓ الرطوبة مناسبة", "⚠ الرطوبة منخفضة"),
+        ],
+        'unknown_region': 'غير معروفة',
+        'no_results': "❌ لم نجد توصيات للمنطقة {region}\n\nجرب الإدخال المخصص أو اختر منطقة أخرى",
+        'header': "التوصيات لمنطقة: {region}\n\n",
+        'custom_header': "🌾 التوصيات بناءً على بيانات التربة:\n\n",
+        'sample_caption': "📊 أفضل المحاصيل (نموذج)",
+        'suggested': "المحاصيل المقترحة:\n\n",
+        'score': "تقييم التوصية: {score}%\n",
+    },
+    'en': {
+        'reasons': [
+            (CHECK_PH, "✓ Soil pH is suitable", "✗ Soil pH is not ideal"),
+            (CHECK_NITROGEN, "✓ Nitrogen is sufficient", "⚠ Nitrogen is low"),
+            (CHECK_RAINFALL, "✓ Rainfall is suitable", "⚠ Rainfall is low"),
+            (CHECK_MOISTURE, "✓ Moisture is suitable", "⚠ Moisture is low"),
+        ],
+        'unknown_region': 'Unknown',
+        'no_results': "❌ No recommendations found for {region}\n\nTry custom input or choose another region",
+        'header': "Recommendations for: {region}\n\n",
+        'custom_header': "🌾 Recommendations based on soil data:\n\n",
+        'sample_caption': "📊 Top crops (sample)",
+        'suggested': "Suggested crops:\n\n",
+        'score': "Recommendation score: {score}%\n",
+    },
+}
+
+CAPTION_RECOMMENDATIONS = 5  # Number of crops described in the caption
+
+
+def get_text_catalog(language=None):
+    """الحصول على نصوص التوصيات للغة المطلوبة (العربية افتراضياً)"""
+    return TEXT_CATALOG.get(language or config.DEFAULT_LANGUAGE, TEXT_CATALOG['ar'])
+
+
+class Recommendation:
+    """نتيجة توصية لمحصول واحد مع قناع بتات للفحوصات الناجحة"""
+    __slots__ = ('crop', 'score', 'checks')
+    
+    def __init__(self, crop, score, checks):
+        self.crop = crop
+        self.score = score
+        self.checks = checks
+    
+    def __repr__(self):
+        return f"Recommendation(crop={self.crop!r}, score={self.score!r}, checks={self.checks:#06b})"
+    
+    def reasons(self, language=None):
+        """تحويل قناع الفحوصات إلى نصوص الأسباب باللغة المطلوبة"""
+        catalog = get_text_catalog(language)['reasons']
+        return [passed if self.checks & flag else failed for flag, passed, failed in catalog]
+
+
 # ============================================================================
 # DATA MANAGER CLASS
 # ============================================================================
@@ -73,7 +249,7 @@ class DataManager:
         }
         self.soil_df = pd.DataFrame(soil_data)
         self.soil_df.to_csv(self.soil_csv_path, index=False)
-        print(f"✅ تم إنشاء بيانات التربة الافتراضية في: {self.soil_csv_path}")
+        logger.info("تم إنشاء بيانات التربة الافتراضية في: %s", self.soil_csv_path)
     
     def _create_default_crop_data(self):
         """إنشاء مجموعة البيانات الافتراضية لمتطلبات المحاصيل"""
@@ -93,7 +269,7 @@ class DataManager:
         }
         self.crop_df = pd.DataFrame(crop_data)
         self.crop_df.to_csv(self.crop_csv_path, index=False)
-        print(f"✅ تم إنشاء بيانات متطلبات المحاصيل الافتراضية في: {self.crop_csv_path}")
+        logger.info("تم إنشاء بيانات متطلبات المحاصيل الافتراضية في: %s", self.crop_csv_path)
     
     def get_recommended_crops(self, soil_params):
         """
@@ -107,7 +283,7 @@ class DataManager:
         
         for _, crop in self.crop_df.iterrows():
             score = 0
-            reasons = []
+            checks = 0
             
             # Check temperature range (0-25 points)
             if soil_params.get('temperature', 20) >= crop['min_temperature'] and \
@@ -122,41 +298,30 @@ class DataManager:
             if soil_params.get('ph', 7.5) >= crop['min_ph'] and \
                soil_params.get('ph', 7.5) <= crop['max_ph']:
                 score += 20
-                reasons.append("✓ حموضة التربة مناسبة")
+                checks |= CHECK_PH
             else:
-                reasons.append("✗ حموضة التربة غير مثالية")
                 score += 5
             
             # Check nitrogen (0-15 points)
             if soil_params.get('nitrogen_ppm', 50) >= crop['min_nitrogen_ppm'] * 0.8:
                 score += 15
-                reasons.append("✓ النيتروجين كافٍ")
-            else:
-                reasons.append("⚠ النيتروجين منخفض")
+                checks |= CHECK_NITROGEN
             
             # Check rainfall (0-20 points)
             if soil_params.get('rainfall_mm', 200) >= crop['min_rainfall_mm'] * 0.7:
                 score += 20
-                reasons.append("✓ الأمطار مناسبة")
-            else:
-                reasons.append("⚠ الأمطار منخفضة")
+                checks |= CHECK_RAINFALL
             
             # Check moisture (0-20 points)
             if soil_params.get('moisture_content_percent', 30) >= crop['min_moisture_percent'] * 0.7:
                 score += 20
-                reasons.append("✓ الرطوبة مناسبة")
-            else:
-                reasons.append("⚠ الرطوبة منخفضة")
+                checks |= CHECK_MOISTURE
             
             if score >= 40:  # Only recommend if score >= 40
-                recommendations.append({
-                    'crop': crop['crop_name'],
-                    'score': score,
-                    'reasons': reasons
-                })
+                recommendations.append(Recommendation(crop['crop_name'], score, checks))
         
         # Sort by score (descending)
-        recommendations.sort(key=lambda x: x['score'], reverse=True)
+        recommendations.sort(key=lambda x: x.score, reverse=True)
         return recommendations[:config.TOP_RECOMMENDATIONS]  # Return top 5
     
     def add_soil_data(self, new_data_dict):
@@ -215,8 +380,8 @@ class VisualizationManager:
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
         
         # ===== LEFT CHART: Recommendations Bar Chart =====
-        crops = [VisualizationManager.fix_arabic_text(r['crop']) for r in recommendations]
-        scores = [r['score'] for r in recommendations]
+        crops = [VisualizationManager.fix_arabic_text(r.crop) for r in recommendations]
+        scores = [r.score for r in recommendations]
         colors = ['#2ecc71' if s >= 80 else '#f39c12' if s >= 60 else '#e74c3c' for s in scores]
         
         ax1.barh(crops, scores, color=colors, edgecolor='black', linewidth=1.5)
@@ -263,8 +428,8 @@ class VisualizationManager:
     def create_recommendation_chart(recommendations):
         """إنشاء رسم بياني شريطي لتوصيات المحاصيل"""
         fig, ax = plt.subplots(figsize=(10, 6))
-        crops = [VisualizationManager.fix_arabic_text(r['crop']) for r in recommendations]
-        scores = [r['score'] for r in recommendations]
+        crops = [VisualizationManager.fix_arabic_text(r.crop) for r in recommendations]
+        scores = [r.score for r in recommendations]
         colors = ['#2ecc71' if s >= 80 else '#f39c12' if s >= 60 else '#e74c3c' for s in scores]
         
         ax.barh(crops, scores, color=colors, edgecolor='black', linewidth=1.5)
@@ -430,16 +595,20 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             'moisture_content_percent': 30
         }
         await query.message.delete()
-        recommendations = data_manager.get_recommended_crops(sample_params)
-        fig = viz_manager.create_recommendation_chart(recommendations)
-        chart_bytes = viz_manager.save_chart_to_bytes(fig)
+        trace = new_trace(user_id, query.data)
+        with log_span(trace, 'scoring'):
+            recommendations = data_manager.get_recommended_crops(sample_params)
+        with log_span(trace, 'rendering'):
+            fig = viz_manager.create_recommendation_chart(recommendations)
+            chart_bytes = viz_manager.save_chart_to_bytes(fig)
         keyboard = [[InlineKeyboardButton("← رجوع", callback_data='back_main')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.message.reply_photo(
-            photo=chart_bytes,
-            caption="📊 أفضل المحاصيل (نموذج)",
-            reply_markup=reply_markup
-        )
+        with log_span(trace, 'send'):
+            await query.message.reply_photo(
+                photo=chart_bytes,
+                caption=get_text_catalog()['sample_caption'],
+                reply_markup=reply_markup
+            )
 
 
     elif query.data == 'about':
@@ -492,36 +661,37 @@ Python، Pandas، NumPy، Matplotlib
 async def show_recommendations(query, user_id):
     """عرض توصيات المحاصيل"""
     soil_params = user_data_store.get(user_id, {}).get('soil_params', {})
-    region = user_data_store.get(user_id, {}).get('region', 'غير معروفة')
+    text = get_text_catalog()
+    region = user_data_store.get(user_id, {}).get('region', text['unknown_region'])
     
-    recommendations = data_manager.get_recommended_crops(soil_params)
+    trace = new_trace(user_id, query.data)
+    with log_span(trace, 'scoring'):
+        recommendations = data_manager.get_recommended_crops(soil_params)
     
     if not recommendations:
-        await query.edit_message_text(
-            f"❌ لم نجد توصيات للمنطقة {region}\n\n"
-            "جرب الإدخال المخصص أو اختر منطقة أخرى"
-        )
+        with log_span(trace, 'send'):
+            await query.edit_message_text(text['no_results'].format(region=region))
         return
     
     # Create recommendation text
-    rec_text = f"التوصيات لمنطقة: {region}\n\n"
-    rec_text += "المحاصيل المقترحة:\n\n"
-    for i, rec in enumerate(recommendations, 1):
-        rec_text += f"{i}️⃣ {rec['crop']}\n"
-        rec_text += f"تقييم التوصية: {rec['score']}%\n"
-        for reason in rec['reasons']:
+    rec_text = text['header'].format(region=region)
+    rec_text += text['suggested']
+    for i, rec in enumerate(recommendations[:CAPTION_RECOMMENDATIONS], 1):
+        rec_text += f"{i}️⃣ {rec.crop}\n"
+        rec_text += text['score'].format(score=rec.score)
+        for reason in rec.reasons():
             rec_text += f"   {reason}\n"
         rec_text += "\n"
-        if i == 5:
-            break
     keyboard = [
         [InlineKeyboardButton("← رجوع", callback_data='back_main')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    fig = viz_manager.create_combined_charts(recommendations, soil_params)
-    chart_bytes = viz_manager.save_chart_to_bytes(fig)
-    await query.delete_message()
-    await query.message.reply_photo(photo=chart_bytes, caption=rec_text,reply_markup=reply_markup)
+    with log_span(trace, 'rendering'):
+        fig = viz_manager.create_combined_charts(recommendations, soil_params)
+        chart_bytes = viz_manager.save_chart_to_bytes(fig)
+    with log_span(trace, 'send'):
+        await query.delete_message()
+        await query.message.reply_photo(photo=chart_bytes, caption=rec_text,reply_markup=reply_markup)
     
 async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """معالجة إدخال بيانات التربة المخصصة"""
@@ -559,19 +729,24 @@ async def handle_custom_input(update: Update, context: ContextTypes.DEFAULT_TYPE
             user_data_store[user_id]['soil_params']['ph'] = ph
             
             # Get recommendations
-            recommendations = data_manager.get_recommended_crops(user_data_store[user_id]['soil_params'])
+            trace = new_trace(user_id, 'custom_input')
+            with log_span(trace, 'scoring'):
+                recommendations = data_manager.get_recommended_crops(user_data_store[user_id]['soil_params'])
             
-            rec_text = "🌾 التوصيات بناءً على بيانات التربة:\n\n"
+            rec_text = get_text_catalog()['custom_header']
             for i, rec in enumerate(recommendations, 1):
-                rec_text += f"{i}️⃣ {rec['crop']} ({rec['score']}%)\n"
+                rec_text += f"{i}️⃣ {rec.crop} ({rec.score}%)\n"
             
             # Send recommendations
-            await update.message.reply_text(rec_text)
+            with log_span(trace, 'send_text'):
+                await update.message.reply_text(rec_text)
             
             # Create and send chart
-            fig = viz_manager.create_combined_charts(recommendations, user_data_store[user_id]['soil_params'])
-            chart_bytes = viz_manager.save_chart_to_bytes(fig)
-            await update.message.reply_photo(photo=chart_bytes)
+            with log_span(trace, 'rendering'):
+                fig = viz_manager.create_combined_charts(recommendations, user_data_store[user_id]['soil_params'])
+                chart_bytes = viz_manager.save_chart_to_bytes(fig)
+            with log_span(trace, 'send_photo'):
+                await update.message.reply_photo(photo=chart_bytes)
             
             context.user_data.clear()
             await start(update, context)
@@ -599,8 +774,7 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         file = await update.message.document.get_file()
         tmp_path = tempfile.mkdtemp()
         full_path = await file.download_to_drive(custom_path=os.path.join(tmp_path, 'new_soil_data.csv'))
-        print(full_path)
-        print(full_path.name)
+        logger.debug("تم تنزيل الملف: %s", full_path, extra={'user_id': user_id, 'callback': 'add_soil_csv'})
         if not full_path or not full_path.name.endswith('.csv'):
             await update.message.reply_text("❌ الملف يجب أن يكون بصيغة CSV")
             return
@@ -619,11 +793,13 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             data = row.to_dict()
             data_manager.add_soil_data(data)
         
+        logger.info("تمت إضافة %d صفاً من بيانات التربة", len(new_data_df), extra={'user_id': user_id, 'callback': 'add_soil_csv'})
         await update.message.reply_text(f"✅ تمت إضافة بيانات التربة بنجاح!\nعدد الصفوف المضافة: {len(new_data_df)}")
         context.user_data.clear()
         await start(update, context)
         
     except Exception as e:
+        logger.exception("فشل إضافة بيانات التربة", extra={'user_id': user_id, 'callback': 'add_soil_csv'})
         await update.message.reply_text(f"❌ حدث خطأ: {str(e)}")
 
 
@@ -635,6 +811,8 @@ async def handle_admin_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 def main():
     """تشغيل البوت"""
     print("🚀 جارٍ تشغيل نظام IQ-FARM...")
+    log_listener = start_log_listener()
+    logger.info("بدء تشغيل البوت")
     
     app = Application.builder().token(TOKEN).build()
     
@@ -645,7 +823,10 @@ def main():
     app.add_handler(MessageHandler(filters.Document.FileExtension("csv"), handle_admin_input))
     
     # Run
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        log_listener.stop()
 
 
 if __name__ == '__main__':